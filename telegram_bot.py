@@ -18,20 +18,45 @@ Original file is located at
 
 import logging
 import os
-import json
-import datetime
+from datetime import datetime, timezone
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+import contextlib
+import functools
+import sys
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Any, Awaitable, Callable, Final, NamedTuple
+import httpx
+import orjson
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PersistenceInput,
+    PicklePersistence,
+    SimpleUpdateProcessor,
     filters,
 )
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from google.oauth2 import service_account
+from google.cloud import firestore
+from google.api_core.exceptions import (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    InvalidArgument,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
 
 # --- КОНФИГУРАЦИЯ ---
 
@@ -44,7 +69,13 @@ FIREBASE_CONFIG_JSON = os.getenv("FIREBASE_CONFIG_JSON")
 # Константы для Webhook
 PORT = int(os.environ.get("PORT", "10000"))
 WEBHOOK_PATH = TELEGRAM_TOKEN or "secret-path"
-WEBHOOK_URL = f"{RENDER_EXTERNAL_HOSTNAME}/{WEBHOOK_PATH}" if RENDER_EXTERNAL_HOSTNAME else None
+# Полный URL вебхука (со схемой) собирается один раз и используется везде
+WEBHOOK_URL = f"https://{RENDER_EXTERNAL_HOSTNAME}/{WEBHOOK_PATH}" if RENDER_EXTERNAL_HOSTNAME else None
+
+# Файл для сохранения состояния диалогов между перезапусками сервиса
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "/tmp/bot_state.pickle")
+# Размер пула соединений к api.telegram.org (задается в одном месте: PTB берет лимит из httpx.Limits)
+TELEGRAM_POOL_SIZE = 256
 
 # Константы для бота
 (
@@ -64,121 +95,440 @@ INFO_BTN = "❓ Помощь"
 EMERGENCY_BTN = "🚨 Экстренный вызов"
 CANCEL_BTN = "❌ Отмена"
 
-# Настройка логирования
+# Допустимые ответы на вопрос о боли: текст кнопки -> балл
+PAIN_SCORES = {str(i): i for i in range(11)}
+
+# Варианты ответов из небольшого словаря. Ответ пользователя заменяется общим
+# интернированным экземпляром строки, и состояние опросов не хранит копию на каждое сообщение.
+SLEEP_OPTIONS = ("Отлично", "Хорошо", "Удовлетворительно", "Плохо", "Очень плохо")
+MEDICATION_OPTIONS = ("Да", "Нет")
+SLEEP_ANSWERS = {s: sys.intern(s) for s in SLEEP_OPTIONS}
+MEDICATION_ANSWERS = {s: sys.intern(s) for s in MEDICATION_OPTIONS}
+# Частые ответы на свободные вопросы (побочные эффекты, комментарии)
+FREE_TEXT_ANSWERS = {s: sys.intern(s) for s in ("Нет",)}
+
+# Свободный текст (ответы опроса, обратная связь) обрезается до MAX_TEXT_LENGTH символов,
+# чтобы ограничить размер записи в Firestore. Управляющие ASCII-символы, кроме перевода
+# строки и табуляции, удаляются одним проходом str.translate.
+MAX_TEXT_LENGTH = 2048
+CONTROL_CHARS_TABLE = dict.fromkeys(
+    [code for code in range(32) if chr(code) not in "\n\t"] + [127]
+)
+
+def sanitize_text(text: str) -> str:
+    """Обрезает текст до MAX_TEXT_LENGTH (до strip, чтобы не сканировать длинный хвост) и чистит его."""
+    return text[:MAX_TEXT_LENGTH].translate(CONTROL_CHARS_TABLE).strip()
+
+# Фильтры кнопок создаются один раз при импорте и переиспользуются всеми обработчиками.
+# Текст кнопки сравнивается на точное равенство, без регулярных выражений.
+BUTTON_FILTERS = {
+    button: filters.Text((button,))
+    for button in (SURVEY_BTN, FEEDBACK_BTN, CANCEL_BTN)
+}
+
+# Ответ пользователя внутри диалога: любой текст, кроме команд и кнопки отмены
+ANSWER_FILTER = filters.TEXT & ~filters.COMMAND & ~BUTTON_FILTERS[CANCEL_BTN]
+# Любой текст вне диалогов, кроме команд: разбирается маршрутизатором route_text
+ROUTER_FILTER = filters.TEXT & ~filters.COMMAND
+
+# Настройка логирования. Уровень задается переменной среды LOG_LEVEL
+# (в продакшене, например, WARNING); сообщения форматируются лениво (%s),
+# поэтому отфильтрованные по уровню строки не собираются вовсе.
+# Неизвестное имя уровня не должно ронять сервис при импорте: используется INFO.
+LOG_LEVEL_NAME = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVEL = logging.getLevelName(LOG_LEVEL_NAME) # Для неизвестного имени вернется строка "Level ..."
+LOG_LEVEL_VALID = isinstance(LOG_LEVEL, int)
+if not LOG_LEVEL_VALID:
+    LOG_LEVEL = logging.INFO
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="{asctime} - {name} - {levelname} - {message}", style="{", level=LOG_LEVEL
 )
+# httpx пишет строку на каждый запрос к Telegram API, а telegram - на каждое
+# служебное событие; под нагрузкой это основной объем логов
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("telegram").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
+if not LOG_LEVEL_VALID:
+    logger.warning("Неизвестный LOG_LEVEL=%r, используется INFO.", LOG_LEVEL_NAME)
 
 # --- Инициализация Firebase ---
 
 db = None
 firebase_app_id = "default-app-id" # Запасное значение, если не получено
+firebase_credentials = None # Кэш учетных данных сервисного аккаунта
+users_col = None # Ссылка на коллекцию artifacts/{appId}/users
+
+# Пакетная запись опросов: не более SURVEY_BATCH_SIZE документов за один commit
+# (предел Firestore для WriteBatch - 500, но пакет атомарен, и меньший размер ограничивает
+# объем повторной записи по одному при ошибке), накопление пакета длится не дольше
+# SURVEY_FLUSH_INTERVAL секунд
+SURVEY_BATCH_SIZE = int(os.getenv("SURVEY_BATCH_SIZE", "100"))
+SURVEY_FLUSH_INTERVAL = float(os.getenv("SURVEY_FLUSH_INTERVAL", "0.2"))
+# Очередь ограничена, чтобы при недоступности Firestore память не росла бесконечно
+SURVEY_QUEUE_MAXSIZE = 10000
+survey_write_queue: asyncio.Queue = asyncio.Queue(maxsize=SURVEY_QUEUE_MAXSIZE)
+survey_writer_task = None
+SURVEY_QUEUE_STOP = None # Сигнал фоновой задаче: записать накопленное и завершиться
+
+# Одновременно выполняется не более FS_MAX_INFLIGHT записей в Firestore: при всплеске
+# нагрузки остальные ждут семафор, а не копят запросы до grpc Deadline Exceeded.
+# Временные ошибки повторяются с экспоненциальной задержкой (0.1, 0.2, 0.4, ... с).
+# Встроенный повтор библиотеки (до 60 с на вызов) отключается, а каждая попытка
+# ограничена FS_WRITE_TIMEOUT, чтобы одна запись не занимала слот семафора минутами.
+FS_MAX_INFLIGHT = int(os.getenv("FS_MAX_INFLIGHT", "64"))
+FS_WRITE_ATTEMPTS = 5
+FS_WRITE_TIMEOUT = 10.0
+FS_RETRY_BASE_DELAY = 0.1
+# Встроенный повтор библиотеки для commit покрывает ResourceExhausted (квота, лимит
+# скорости записи - 429) и ServiceUnavailable; раз он отключен, эти и другие временные
+# ошибки повторяются здесь
+FS_RETRYABLE_ERRORS = (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
+fs_semaphore = asyncio.Semaphore(FS_MAX_INFLIGHT)
 
 def init_firebase():
-    """Инициализирует Firebase Admin SDK."""
+    """Инициализирует асинхронный клиент Firestore."""
     global db
     global firebase_app_id
+    global firebase_credentials
+    global users_col
+
+    # Повторная инициализация (перезагрузка модуля, тесты) не нужна
+    if db is not None:
+        return
 
     if FIREBASE_CONFIG_JSON:
         try:
             # Парсинг JSON-строки из переменной среды
-            cred_json = json.loads(FIREBASE_CONFIG_JSON)
+            cred_json = orjson.loads(FIREBASE_CONFIG_JSON)
             
             # Извлечение project_id из ключа для использования в качестве appId
             firebase_app_id = cred_json.get("project_id", "default-app-id")
 
-            # Инициализация с помощью учетных данных сервисного аккаунта
-            cred = credentials.Certificate(cred_json)
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            logger.info(f"✅ Firebase Admin SDK успешно инициализирован (Project: {firebase_app_id}).")
+            # Учетные данные сервисного аккаунта создаются напрямую через google-auth,
+            # без промежуточного firebase_admin.credentials.Certificate; разбор
+            # RSA-ключа выполняется один раз, результат переиспользуется.
+            if firebase_credentials is None:
+                firebase_credentials = service_account.Credentials.from_service_account_info(cred_json)
+            # Асинхронный клиент: запись выполняется в цикле событий без потоков
+            db = firestore.AsyncClient(project=firebase_app_id, credentials=firebase_credentials)
+            # Коллекция пользователей создается один раз; используем project_id как appId
+            users_col = db.collection(f"artifacts/{firebase_app_id}/users")
+            clear_user_ref_cache()
+            logger.info("✅ Firestore AsyncClient успешно инициализирован (Project: %s).", firebase_app_id)
             
-        except json.JSONDecodeError:
-            logger.error(f"❌ Ошибка инициализации Firebase/Firestore: Неверный формат JSON в FIREBASE_CONFIG_JSON.")
+        except orjson.JSONDecodeError:
+            logger.error("❌ Ошибка инициализации Firebase/Firestore: Неверный формат JSON в FIREBASE_CONFIG_JSON.")
         except Exception as e:
-            logger.error(f"❌ Критическая ошибка при инициализации Firebase: {e}")
+            logger.error("❌ Критическая ошибка при инициализации Firebase: %s", e)
     else:
         logger.warning("⚠️ Переменная FIREBASE_CONFIG_JSON не найдена. Firebase не инициализирован. Данные будут храниться только локально (если бы это не был реальный бот).")
 
+    bind_save_functions()
+
 # --- Утилиты Firebase (сохранение) ---
 
+# Ссылки на документы пользователей кэшируются, чтобы повторные сохранения не создавали
+# цепочку DocumentReference/CollectionReference заново; кэш сбрасывается при смене db
+USER_REF_CACHE_SIZE = 4096
+
+def clear_user_ref_cache():
+    """Сбрасывает кэш ссылок на документы пользователей."""
+    get_user_doc_ref.cache_clear()
+    get_survey_month_doc_ref.cache_clear()
+    get_feedback_collection_ref.cache_clear()
+
+@functools.lru_cache(maxsize=USER_REF_CACHE_SIZE)
 def get_user_doc_ref(user_id: str):
     """Возвращает ссылку на документ профиля пользователя."""
-    # Используем project_id как appId
-    return db.collection(f"artifacts/{firebase_app_id}/users/{user_id}/profile").document("info")
+    return users_col.document(user_id).collection("profile").document("info")
 
-def get_survey_collection_ref(user_id: str):
-    """Возвращает ссылку на коллекцию опросов пользователя."""
-    return db.collection(f"artifacts/{firebase_app_id}/users/{user_id}/surveys")
+@functools.lru_cache(maxsize=USER_REF_CACHE_SIZE)
+def get_survey_month_doc_ref(user_id: str, month: str, part: int = 1):
+    """Возвращает ссылку на часть месячного документа опросов (month - строка YYYY-MM).
 
+    Первая часть - survey_YYYY-MM, следующие - survey_YYYY-MM_2, survey_YYYY-MM_3, ...
+    """
+    doc_id = f"survey_{month}" if part == 1 else f"survey_{month}_{part}"
+    return users_col.document(user_id).collection("surveys").document(doc_id)
+
+@functools.lru_cache(maxsize=USER_REF_CACHE_SIZE)
 def get_feedback_collection_ref(user_id: str):
     """Возвращает ссылку на коллекцию обратной связи пользователя."""
-    return db.collection(f"artifacts/{firebase_app_id}/users/{user_id}/feedback")
+    return users_col.document(user_id).collection("feedback")
 
-async def save_user_profile(user_data: dict, user_id: int):
-    """Сохраняет или обновляет профиль пользователя в Firestore."""
-    if db is None:
-        logger.warning("Не удалось сохранить профиль: DB не инициализирована.")
-        return
+async def firestore_write(write: Callable[..., Awaitable[Any]]) -> Any:
+    """Выполняет запись в Firestore с ограничением параллелизма и повтором временных ошибок.
 
+    write - метод записи Firestore (set/commit, при необходимости через functools.partial);
+    на каждую попытку он вызывается заново с retry=None и timeout=FS_WRITE_TIMEOUT.
+    """
+    for attempt in range(FS_WRITE_ATTEMPTS):
+        try:
+            async with fs_semaphore:
+                return await write(retry=None, timeout=FS_WRITE_TIMEOUT)
+        except FS_RETRYABLE_ERRORS:
+            if attempt == FS_WRITE_ATTEMPTS - 1:
+                raise
+        # Пауза перед повтором выдерживается вне семафора, не занимая слот
+        await asyncio.sleep(FS_RETRY_BASE_DELAY * 2 ** attempt)
+
+async def save_user_profile_firestore(user_data: dict, user_id: int):
+    """Сохраняет или обновляет профиль пользователя в Firestore."""
     try:
         doc_ref = get_user_doc_ref(str(user_id))
-        await asyncio.to_thread(doc_ref.set, user_data, merge=True)
-        logger.info(f"Профиль пользователя {user_id} сохранен/обновлен.")
+        await firestore_write(functools.partial(doc_ref.set, user_data, merge=True))
+        logger.info("Профиль пользователя %s сохранен/обновлен.", user_id)
     except Exception as e:
-        logger.error(f"Ошибка сохранения профиля пользователя {user_id}: {e}")
+        logger.error("Ошибка сохранения профиля пользователя %s: %s", user_id, e)
 
-async def save_survey_results(user_id: int, results: dict):
-    """Сохраняет результаты опроса в Firestore."""
-    if db is None:
-        logger.warning("Не удалось сохранить опрос: DB не инициализирована.")
-        return
+async def save_survey_results_firestore(user_id: int, results: dict) -> bool:
+    """Ставит результаты опроса в очередь на пакетную запись в Firestore.
+
+    Возвращает True, если результаты приняты в очередь; сама запись выполняется фоновой задачей.
+    """
+    results["user_id"] = str(user_id)
 
+    # Запись выполнит фоновая задача. Метка времени фиксируется дешевым time.time(),
+    # в datetime (UTC) и месяц документа она переводится уже в фоновой задаче.
     try:
-        # Добавляем метку времени
-        results["timestamp"] = datetime.datetime.now(datetime.timezone.utc)
-        results["user_id"] = str(user_id)
-        
-        collection_ref = get_survey_collection_ref(str(user_id))
-        await asyncio.to_thread(collection_ref.add, results)
-        logger.info(f"Результаты опроса для пользователя {user_id} сохранены.")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения результатов опроса для пользователя {user_id}: {e}")
+        survey_write_queue.put_nowait((results["user_id"], results, time.time()))
+    except asyncio.QueueFull:
+        logger.error("Очередь записи опросов переполнена, результаты пользователя %s не сохранены.", user_id)
+        return False
+    logger.info("Результаты опроса для пользователя %s поставлены в очередь на запись.", user_id)
+    return True
+
+# Месячный документ не может превысить 1 MiB (Firestore считает байты UTF-8, а свободный
+# ответ до 2048 символов занимает до 8 КБ), а число опросов за месяц не ограничено.
+# Когда часть документа переполнена, опросы дописываются в следующую часть месяца.
+# Номер текущей части хранится только для пользователей, у которых был перенос; после
+# перезапуска он восстанавливается одной отклоненной записью на каждую полную часть.
+SURVEY_MONTH_MAX_PARTS = 100
+survey_month_parts: dict[tuple[str, str], int] = {} # (user_id, YYYY-MM) -> номер части
+
+def is_document_too_large(error: Exception) -> bool:
+    """Проверяет, отклонена ли запись из-за превышения предельного размера документа."""
+    return isinstance(error, InvalidArgument) and "maximum allowed size" in str(error)
+
+async def write_survey_entry(user_id: str, month: str, data: dict):
+    """Записывает один опрос в текущую часть месячного документа, переходя к следующей при переполнении."""
+    part = survey_month_parts.get((user_id, month), 1)
+    while True:
+        doc_ref = get_survey_month_doc_ref(user_id, month, part)
+        try:
+            return await firestore_write(functools.partial(doc_ref.set, data, merge=True))
+        except InvalidArgument as e:
+            if not is_document_too_large(e) or part >= SURVEY_MONTH_MAX_PARTS:
+                raise
+        part += 1
+        survey_month_parts[(user_id, month)] = part
+        logger.info("Документ опросов пользователя %s за %s заполнен, переходим к части %d.", user_id, month, part)
+
+async def commit_survey_batch(pending: list):
+    """Записывает накопленные результаты опросов одним пакетом (WriteBatch).
+
+    Пакет атомарен: одна невыполнимая запись отклоняет весь commit. В этом случае
+    опросы записываются по одному, и теряется только тот, который записать нельзя.
+    """
+    writes = []
+    batch = db.batch()
+    for user_id, results, saved_at in pending:
+        timestamp = datetime.fromtimestamp(saved_at, timezone.utc)
+        results["timestamp"] = timestamp
+        # Опросы пользователя за месяц хранятся в документе surveys/survey_YYYY-MM (и его
+        # продолжениях при переполнении): история за месяц читается одним-двумя документами.
+        # ArrayUnion дописывает опрос в массив, не перезаписывая остальные поля документа.
+        month = timestamp.strftime("%Y-%m")
+        part = survey_month_parts.get((user_id, month), 1)
+        data = {"entries": firestore.ArrayUnion([results])}
+        batch.set(get_survey_month_doc_ref(user_id, month, part), data, merge=True)
+        writes.append((user_id, month, data))
 
-async def save_feedback(user_id: int, text: str):
-    """Сохраняет сообщение обратной связи в Firestore."""
-    if db is None:
-        logger.warning("Не удалось сохранить обратную связь: DB не инициализирована.")
+    try:
+        # При ошибке пакет не очищается, поэтому повторный commit отправляет те же записи
+        await firestore_write(batch.commit)
+        logger.info("Пакет результатов опроса сохранен: %d шт.", len(pending))
         return
+    except Exception as e:
+        logger.error(
+            "Ошибка пакетного сохранения результатов опроса (%d шт.): %s; записываем по одному",
+            len(pending), e,
+        )
 
+    # Одиночные записи идут параллельно; их число все равно ограничивает семафор firestore_write.
+    # Переполненный месячный документ при этом сменяется следующей частью.
+    outcomes = await asyncio.gather(
+        *(write_survey_entry(user_id, month, data) for user_id, month, data in writes),
+        return_exceptions=True,
+    )
+    failed = 0
+    for (user_id, _, _), outcome in zip(writes, outcomes):
+        if isinstance(outcome, Exception):
+            failed += 1
+            logger.error("Ошибка сохранения результатов опроса пользователя %s: %s", user_id, outcome)
+    logger.info("Результаты опроса записаны по одному: %d из %d шт.", len(writes) - failed, len(writes))
+
+async def survey_batch_writer():
+    """Фоновая задача: собирает опросы из очереди и сохраняет их пакетами."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        # Ждем первый опрос, затем добираем пакет до лимита или до истечения интервала
+        item = await survey_write_queue.get()
+        if item is SURVEY_QUEUE_STOP:
+            break
+        pending = [item]
+        deadline = loop.time() + SURVEY_FLUSH_INTERVAL
+        while len(pending) < SURVEY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(survey_write_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is SURVEY_QUEUE_STOP:
+                stopping = True
+                break
+            pending.append(item)
+
+        await commit_survey_batch(pending)
+
+async def save_feedback_firestore(user_id: int, text: str):
+    """Сохраняет сообщение обратной связи в Firestore."""
     try:
+        now = datetime.now(timezone.utc)
         data = {
             "text": text,
-            "timestamp": datetime.datetime.now(datetime.timezone.utc),
+            "timestamp": now,
             "user_id": str(user_id)
         }
+        # ID документа формируется на клиенте: дата в начале упорядочивает сообщения по имени
+        doc_id = f"{now.date().isoformat()}_{uuid.uuid4().hex[:8]}"
         collection_ref = get_feedback_collection_ref(str(user_id))
-        await asyncio.to_thread(collection_ref.add, data)
-        logger.info(f"Обратная связь от пользователя {user_id} сохранена.")
+        await firestore_write(functools.partial(collection_ref.document(doc_id).set, data))
+        logger.info("Обратная связь от пользователя %s сохранена.", user_id)
     except Exception as e:
-        logger.error(f"Ошибка сохранения обратной связи для пользователя {user_id}: {e}")
+        logger.error("Ошибка сохранения обратной связи для пользователя %s: %s", user_id, e)
+
+# Заглушки на случай, когда Firestore не инициализирован: данные не сохраняются
+
+async def save_user_profile_unavailable(user_data: dict, user_id: int):
+    """Заглушка сохранения профиля: Firestore не инициализирован."""
+    logger.warning("Не удалось сохранить профиль: DB не инициализирована.")
+
+async def save_survey_results_unavailable(user_id: int, results: dict) -> bool:
+    """Заглушка сохранения опроса: Firestore не инициализирован, возвращает False."""
+    logger.warning("Не удалось сохранить опрос: DB не инициализирована.")
+    return False
+
+async def save_feedback_unavailable(user_id: int, text: str):
+    """Заглушка сохранения обратной связи: Firestore не инициализирован."""
+    logger.warning("Не удалось сохранить обратную связь: DB не инициализирована.")
+
+# Обработчики вызывают save_user_profile, save_survey_results и save_feedback, не проверяя db:
+# реализация выбирается один раз, при инициализации и закрытии клиента Firestore
+save_user_profile = save_user_profile_unavailable
+save_survey_results = save_survey_results_unavailable
+save_feedback = save_feedback_unavailable
+
+def bind_save_functions():
+    """Подставляет функции сохранения в Firestore или заглушки в зависимости от состояния db."""
+    global save_user_profile
+    global save_survey_results
+    global save_feedback
+
+    available = db is not None
+    save_user_profile = save_user_profile_firestore if available else save_user_profile_unavailable
+    save_survey_results = save_survey_results_firestore if available else save_survey_results_unavailable
+    save_feedback = save_feedback_firestore if available else save_feedback_unavailable
 
 # --- Функции клавиатуры и меню ---
 
-def get_main_menu_keyboard():
-    """Возвращает разметку для главного меню."""
-    # Используем кнопки в ряд
-    keyboard = [
+# Клавиатуры не меняются между вызовами, поэтому создаются один раз при импорте
+MAIN_MENU_KB = ReplyKeyboardMarkup(
+    [
         [SURVEY_BTN, FEEDBACK_BTN],
         [ILLNESS_BTN, INFO_BTN],
         [KeyboardButton(EMERGENCY_BTN)],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
 
-def get_cancel_keyboard():
-    """Возвращает клавиатуру только с кнопкой отмены."""
-    return ReplyKeyboardMarkup([[CANCEL_BTN]], resize_keyboard=True, one_time_keyboard=True)
+PAIN_KB = ReplyKeyboardMarkup(
+    [[KeyboardButton(str(i)) for i in range(0, 6)],
+     [KeyboardButton(str(i)) for i in range(6, 11)]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
+SLEEP_KB = ReplyKeyboardMarkup(
+    [list(SLEEP_OPTIONS[:3]), list(SLEEP_OPTIONS[3:])],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
+MEDICATION_KB = ReplyKeyboardMarkup(
+    [list(MEDICATION_OPTIONS)],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+
+CANCEL_KB = ReplyKeyboardMarkup([[CANCEL_BTN]], resize_keyboard=True, one_time_keyboard=True)
+
+# --- Справочные тексты ---
+
+# Тексты не меняются, поэтому создаются один раз. Разметка - HTML: ее разбор на стороне
+# Telegram проще устаревшего Markdown и не требует экранирования "_" и "*" в тексте.
+PM_HTML = ParseMode.HTML
+
+ILLNESS_TEXT: Final[str] = (
+    "🧠 <b>Постинсультный таламический синдром (синдром Дежерин-Русси)</b>\n\n"
+    "Это комплекс неврологических нарушений, возникающих после повреждения таламуса в результате инсульта. "
+    "Его главной характеристикой является <b>таламическая боль</b> — сильная, часто жгучая, трудно поддающаяся лечению боль. "
+    "Симптомы могут также включать онемение, повышенную чувствительность к раздражителям (аллодиния), "
+    "нарушения сна, эмоциональные расстройства и двигательные нарушения.\n\n"
+    "<b>Цель нашего бота</b> — помочь вам ежедневно отслеживать интенсивность этих симптомов, чтобы ваш врач мог максимально точно скорректировать терапию."
+)
+
+INFO_TEXT: Final[str] = (
+    "❓ <b>Как пользоваться ботом</b>\n\n"
+    "1. <b>📊 Начать опрос:</b> Ежедневно отвечайте на 5 простых вопросов о боли, сне и приеме лекарств. "
+    "Это позволяет вести точный дневник вашего состояния. Все данные сохраняются в базу Firestore.\n"
+    "2. <b>✉️ Обратная связь:</b> Отправьте сообщение для вашего врача или команды поддержки.\n"
+    "3. <b>🧠 О синдроме:</b> Узнайте больше о вашем заболевании.\n"
+    "4. <b>🚨 Экстренный вызов:</b> Получите контактные данные для неотложной помощи.\n\n"
+    "<b>Внимание:</b> Этот бот не является заменой медицинскому специалисту или экстренной службе. Всегда консультируйтесь с врачом!"
+)
+
+EMERGENCY_TEXT: Final[str] = (
+    "🚨 <b>ЭКСТРЕННАЯ ПОМОЩЬ</b>\n\n"
+    "Если вы чувствуете резкое ухудшение состояния, пожалуйста, немедленно обратитесь к врачу или вызовите скорую помощь!\n\n"
+    "📞 <b>Единый номер экстренных служб (Россия):</b> <code>112</code>\n"
+    "📞 <b>Ваш лечащий врач/клиника:</b> [Место для контактов вашего врача или клиники]\n\n"
+    "<b>НЕ ИСПОЛЬЗУЙТЕ ЭТОТ БОТ ДЛЯ ЭКСТРЕННЫХ СЛУЧАЕВ.</b>"
+)
+
+# Готовые аргументы reply_text для справочных разделов: обработчик только передает их дальше
+ILLNESS_REPLY: Final[dict] = {"text": ILLNESS_TEXT, "parse_mode": PM_HTML, "reply_markup": MAIN_MENU_KB}
+INFO_REPLY: Final[dict] = {"text": INFO_TEXT, "parse_mode": PM_HTML, "reply_markup": MAIN_MENU_KB}
+EMERGENCY_REPLY: Final[dict] = {"text": EMERGENCY_TEXT, "parse_mode": PM_HTML, "reply_markup": MAIN_MENU_KB}
+
+SURVEY_DONE_TEXT: Final[str] = (
+    "✅ <b>Опрос завершен!</b>\n\nСпасибо за уделенное время. Ваши данные сохранены и будут использованы вашим врачом для анализа вашего состояния.\n"
+    "Вы можете начать новый опрос завтра или выбрать другие опции в меню."
+)
+SURVEY_SAVE_FAILED_TEXT: Final[str] = (
+    "⚠️ <b>Не удалось сохранить результаты опроса.</b>\n\nПожалуйста, попробуйте пройти опрос позже. "
+    "Если ошибка повторяется, сообщите о ней через раздел обратной связи."
+)
 
 # --- Функции обработчиков (Handlers) ---
 
@@ -193,53 +543,29 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "username": user.username,
         "language_code": user.language_code,
         "chat_id": update.effective_chat.id,
-        "last_login": datetime.datetime.now(datetime.timezone.utc)
+        "last_login": datetime.now(timezone.utc)
     }
     # Запускаем асинхронную задачу сохранения, не блокируя основной поток
     asyncio.create_task(save_user_profile(user_data, user.id))
 
-    await update.message.reply_html(
-        f"Здравствуйте, {user.mention_html()}! Я бот-помощник \"Онлайн-Поликлиники\", созданный для поддержки пациентов с постинсультным таламическим синдромом. "
+    await update.message.reply_text(
+        f"Здравствуйте, {user.first_name}! Я бот-помощник \"Онлайн-Поликлиники\", созданный для поддержки пациентов с постинсультным таламическим синдромом. "
         "Я могу помочь вам ежедневно отслеживать ваше состояние, сохранять важные данные для вашего врача и предоставить справочную информацию.\n\n"
         "Выберите действие в меню ниже.",
-        reply_markup=get_main_menu_keyboard(),
+        reply_markup=MAIN_MENU_KB,
     )
 
 async def show_illness_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает справочную информацию о синдроме."""
-    info_text = (
-        "🧠 **Постинсультный таламический синдром (синдром Дежерин-Русси)**\n\n"
-        "Это комплекс неврологических нарушений, возникающих после повреждения таламуса в результате инсульта. "
-        "Его главной характеристикой является **таламическая боль** — сильная, часто жгучая, трудно поддающаяся лечению боль. "
-        "Симптомы могут также включать онемение, повышенную чувствительность к раздражителям (аллодиния), "
-        "нарушения сна, эмоциональные расстройства и двигательные нарушения.\n\n"
-        "**Цель нашего бота** — помочь вам ежедневно отслеживать интенсивность этих симптомов, чтобы ваш врач мог максимально точно скорректировать терапию."
-    )
-    await update.message.reply_text(info_text, reply_markup=get_main_menu_keyboard(), parse_mode="Markdown")
+    await update.message.reply_text(**ILLNESS_REPLY)
 
 async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает информацию об использовании бота."""
-    info_text = (
-        "❓ **Как пользоваться ботом**\n\n"
-        "1. **📊 Начать опрос:** Ежедневно отвечайте на 5 простых вопросов о боли, сне и приеме лекарств. "
-        "Это позволяет вести точный дневник вашего состояния. Все данные сохраняются в базу Firestore.\n"
-        "2. **✉️ Обратная связь:** Отправьте сообщение для вашего врача или команды поддержки.\n"
-        "3. **🧠 О синдроме:** Узнайте больше о вашем заболевании.\n"
-        "4. **🚨 Экстренный вызов:** Получите контактные данные для неотложной помощи.\n\n"
-        "**Внимание:** Этот бот не является заменой медицинскому специалисту или экстренной службе. Всегда консультируйтесь с врачом!"
-    )
-    await update.message.reply_text(info_text, reply_markup=get_main_menu_keyboard(), parse_mode="Markdown")
+    await update.message.reply_text(**INFO_REPLY)
 
 async def show_emergency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает информацию для экстренных случаев."""
-    emergency_text = (
-        "🚨 **ЭКСТРЕННАЯ ПОМОЩЬ**\n\n"
-        "Если вы чувствуете резкое ухудшение состояния, пожалуйста, немедленно обратитесь к врачу или вызовите скорую помощь!\n\n"
-        "📞 **Единый номер экстренных служб (Россия):** `112`\n"
-        "📞 **Ваш лечащий врач/клиника:** [Место для контактов вашего врача или клиники]\n\n"
-        "**НЕ ИСПОЛЬЗУЙТЕ ЭТОТ БОТ ДЛЯ ЭКСТРЕННЫХ СЛУЧАЕВ.**"
-    )
-    await update.message.reply_text(emergency_text, reply_markup=get_main_menu_keyboard(), parse_mode="Markdown")
+    await update.message.reply_text(**EMERGENCY_REPLY)
 
 # --- Диалог Обратной связи ---
 
@@ -248,13 +574,20 @@ async def feedback_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(
         "Напишите ваше сообщение, вопрос или комментарий. Мы передадим его врачу или команде поддержки.\n"
         "Для отмены нажмите \"❌ Отмена\".",
-        reply_markup=get_cancel_keyboard()
+        reply_markup=CANCEL_KB
     )
     return FEEDBACK
 
 async def feedback_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает и сохраняет сообщение обратной связи."""
-    text = update.message.text
+    text = sanitize_text(update.message.text)
+    if not text:
+        # Пустое после очистки сообщение не сохраняем, диалог остается открытым
+        await update.message.reply_text(
+            "Сообщение пустое. Пожалуйста, напишите текст сообщения или нажмите \"❌ Отмена\".",
+            reply_markup=CANCEL_KB
+        )
+        return FEEDBACK
     user_id = update.effective_user.id
     
     # Сохраняем обратную связь
@@ -262,119 +595,153 @@ async def feedback_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     await update.message.reply_text(
         "Спасибо! Ваше сообщение принято и будет рассмотрено. Если потребуется ответ, мы свяжемся с вами.",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     return ConversationHandler.END
 
 # --- Диалог Опроса (Survey) ---
 
+@dataclass(slots=True)
+class SurveyState:
+    """Ответы пользователя в текущем опросе (хранится в context.user_data["survey"])."""
+    pain_score: int | None = None
+    sleep_quality: str = ""
+    medication_taken: str = ""
+    side_effects: str = ""
+    comments: str = ""
+
+def parse_free_text(text: str) -> str | None:
+    """Свободный ответ очищается sanitize_text (частые ответы заменяются общей строкой).
+
+    Пустой после очистки ответ (только пробелы или управляющие символы) недопустим.
+    """
+    text = sanitize_text(text)
+    if not text:
+        return None
+    return FREE_TEXT_ANSWERS.get(text, text)
+
+class SurveyStep(NamedTuple):
+    """Шаг опроса: состояние диалога, поле SurveyState, разбор ответа и текст вопроса."""
+    state: int
+    field: str
+    parse: Callable[[str], Any] # Возвращает значение поля или None, если ответ недопустим
+    error_text: str
+    prompt: str
+    keyboard: ReplyKeyboardMarkup
+
+# Вопросы опроса по порядку; все шаги обслуживает один обработчик survey_step
+SURVEY_STEPS = (
+    SurveyStep(
+        Q1_PAIN, "pain_score", PAIN_SCORES.get,
+        "Пожалуйста, введите число от 0 до 10.",
+        "<b>Вопрос 1/5:</b> Оцените интенсивность вашей таламической боли по шкале от 0 (нет боли) до 10 (самая сильная боль, которую вы можете себе представить).",
+        PAIN_KB,
+    ),
+    SurveyStep(
+        Q2_SLEEP, "sleep_quality", SLEEP_ANSWERS.get,
+        "Пожалуйста, выберите один из предложенных вариантов качества сна.",
+        "<b>Вопрос 2/5:</b> Как вы оцените качество вашего сна прошлой ночью?",
+        SLEEP_KB,
+    ),
+    SurveyStep(
+        Q3_MEDICATION, "medication_taken", MEDICATION_ANSWERS.get,
+        "Пожалуйста, ответьте 'Да' или 'Нет'.",
+        "<b>Вопрос 3/5:</b> Принимали ли вы сегодня прописанные обезболивающие препараты (например, антиконвульсанты или антидепрессанты)?",
+        MEDICATION_KB,
+    ),
+    SurveyStep(
+        Q4_SIDE_EFFECTS, "side_effects", parse_free_text,
+        "Пожалуйста, опишите побочные эффекты текстом или напишите 'Нет'.",
+        "<b>Вопрос 4/5:</b> Опишите, какие побочные эффекты (если таковые имеются) вы заметили сегодня. "
+        "Если побочных эффектов нет, напишите 'Нет'.",
+        CANCEL_KB,
+    ),
+    SurveyStep(
+        Q5_COMMENTS, "comments", parse_free_text,
+        "Пожалуйста, напишите комментарий текстом или напишите 'Нет'.",
+        "<b>Вопрос 5/5:</b> Хотите ли вы добавить какие-либо другие комментарии о вашем самочувствии сегодня? (Например, о настроении, физической активности, стрессе). "
+        "Если нет, напишите 'Нет'.",
+        CANCEL_KB,
+    ),
+)
+
 async def survey_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Начинает диалог опроса. Вопрос 1: Интенсивность боли."""
-    context.user_data["survey_data"] = {}
-    
-    keyboard = [[KeyboardButton(str(i)) for i in range(0, 6)],
-                [KeyboardButton(str(i)) for i in range(6, 11)]]
-    
-    await update.message.reply_text(
-        "**📊 Ежедневный опрос**\n\n"
-        "**Вопрос 1/5:** Оцените интенсивность вашей таламической боли по шкале от 0 (нет боли) до 10 (самая сильная боль, которую вы можете себе представить).",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True),
-        parse_mode="Markdown"
-    )
-    return Q1_PAIN
+    """Начинает диалог опроса и задает первый вопрос."""
+    context.user_data["survey"] = SurveyState()
+    first_step = SURVEY_STEPS[0]
 
-async def q1_pain(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Вопрос 2: Качество сна."""
-    try:
-        pain_score = int(update.message.text)
-        if not 0 <= pain_score <= 10:
-            raise ValueError
-        context.user_data["survey_data"]["pain_score"] = pain_score
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите число от 0 до 10.")
-        return Q1_PAIN
-
-    keyboard = [["Отлично", "Хорошо", "Удовлетворительно"], ["Плохо", "Очень плохо"]]
-    
     await update.message.reply_text(
-        "**Вопрос 2/5:** Как вы оцените качество вашего сна прошлой ночью?",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+        "<b>📊 Ежедневный опрос</b>\n\n" + first_step.prompt,
+        reply_markup=first_step.keyboard,
+        parse_mode=PM_HTML
     )
-    return Q2_SLEEP
-
-async def q2_sleep(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Вопрос 3: Прием лекарств."""
-    sleep_quality = update.message.text
-    if sleep_quality not in ["Отлично", "Хорошо", "Удовлетворительно", "Плохо", "Очень плохо"]:
-         await update.message.reply_text("Пожалуйста, выберите один из предложенных вариантов качества сна.")
-         return Q2_SLEEP
-
-    context.user_data["survey_data"]["sleep_quality"] = sleep_quality
-    
-    keyboard = [["Да", "Нет"]]
+    return first_step.state
+
+async def survey_step(step_index: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Принимает ответ на вопрос step_index и задает следующий; после последнего сохраняет опрос."""
+    step = SURVEY_STEPS[step_index]
+    value = step.parse(update.message.text)
+    if value is None:
+        await update.message.reply_text(step.error_text)
+        return step.state
+
+    # setdefault создавал бы лишний SurveyState на каждом шаге; новый нужен, только если
+    # состояние потеряно (например, файл состояния диалогов не сохранился)
+    survey = context.user_data.get("survey")
+    if survey is None:
+        survey = context.user_data["survey"] = SurveyState()
+    setattr(survey, step.field, value)
+
+    if step_index + 1 < len(SURVEY_STEPS):
+        next_step = SURVEY_STEPS[step_index + 1]
+        await update.message.reply_text(next_step.prompt, reply_markup=next_step.keyboard, parse_mode=PM_HTML)
+        return next_step.state
+
+    # Ставим результаты в очередь: запись выполнит фоновая задача, ответ пользователю не ждет Firestore
+    # Если результаты не приняты (очередь переполнена, Firestore недоступен), пользователю
+    # нельзя сообщать, что данные сохранены
+    if await save_survey_results(update.effective_user.id, asdict(survey)):
+        done_text = SURVEY_DONE_TEXT
+    else:
+        done_text = SURVEY_SAVE_FAILED_TEXT
     
     await update.message.reply_text(
-        "**Вопрос 3/5:** Принимали ли вы сегодня прописанные обезболивающие препараты (например, антиконвульсанты или антидепрессанты)?",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+        done_text,
+        reply_markup=MAIN_MENU_KB,
+        parse_mode=PM_HTML
     )
-    return Q3_MEDICATION
-
-async def q3_medication(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Вопрос 4: Побочные эффекты."""
-    medication_taken = update.message.text
-    if medication_taken not in ["Да", "Нет"]:
-        await update.message.reply_text("Пожалуйста, ответьте 'Да' или 'Нет'.")
-        return Q3_MEDICATION
-
-    context.user_data["survey_data"]["medication_taken"] = medication_taken
     
-    await update.message.reply_text(
-        "**Вопрос 4/5:** Опишите, какие побочные эффекты (если таковые имеются) вы заметили сегодня. "
-        "Если побочных эффектов нет, напишите 'Нет'.",
-        reply_markup=get_cancel_keyboard()
-    )
-    return Q4_SIDE_EFFECTS
+    # Очистка данных
+    context.user_data.pop("survey", None)
+    return ConversationHandler.END
 
-async def q4_side_effects(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Вопрос 5: Дополнительные комментарии."""
-    side_effects = update.message.text
-    context.user_data["survey_data"]["side_effects"] = side_effects
-    
+async def other_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отвечает на любой другой текст (на случай, если пользователь просто пишет)."""
     await update.message.reply_text(
-        "**Вопрос 5/5:** Хотите ли вы добавить какие-либо другие комментарии о вашем самочувствии сегодня? (Например, о настроении, физической активности, стрессе). "
-        "Если нет, напишите 'Нет'.",
-        reply_markup=get_cancel_keyboard()
+        "Я не понял ваш запрос. Пожалуйста, используйте кнопки меню.",
+        reply_markup=MAIN_MENU_KB
     )
-    return Q5_COMMENTS
 
-async def q5_comments_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Завершает опрос, сохраняет данные и возвращается в главное меню."""
-    comments = update.message.text
-    context.user_data["survey_data"]["comments"] = comments
-    user_id = update.effective_user.id
-    results = context.user_data["survey_data"]
-    
-    # Сохраняем результаты опроса
-    asyncio.create_task(save_survey_results(user_id, results))
-    
-    await update.message.reply_text(
-        "✅ **Опрос завершен!**\n\nСпасибо за уделенное время. Ваши данные сохранены и будут использованы вашим врачом для анализа вашего состояния.\n"
-        "Вы можете начать новый опрос завтра или выбрать другие опции в меню.",
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode="Markdown"
-    )
-    
-    # Очистка данных
-    context.user_data.pop("survey_data", None)
-    return ConversationHandler.END
+# Справочные кнопки меню: точный текст кнопки -> обработчик
+TEXT_ROUTES: dict[str, Callable] = {
+    ILLNESS_BTN: show_illness_info,
+    INFO_BTN: show_info,
+    EMERGENCY_BTN: show_emergency,
+}
+
+async def route_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выбирает обработчик по тексту сообщения одним поиском в словаре; остальное - other_text."""
+    await TEXT_ROUTES.get(update.message.text, other_text)(update, context)
 
 # --- Обработчики отмены ---
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает команду /cancel и завершает текущий диалог."""
+    # Незавершенный опрос больше не нужен и не должен попадать в файл состояния
+    context.user_data.pop("survey", None)
     await update.message.reply_text(
         "Действие отменено. Вы вернулись в главное меню.",
-        reply_markup=get_main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     return ConversationHandler.END
 
@@ -383,85 +750,287 @@ async def cancel_button_handler(update: Update, context: ContextTypes.DEFAULT_TY
     if update.message.text == CANCEL_BTN:
         await update.message.reply_text(
             "Действие отменено. Вы вернулись в главное меню.",
-            reply_markup=get_main_menu_keyboard()
+            reply_markup=MAIN_MENU_KB
         )
         return ConversationHandler.END
     return ConversationHandler.END # Если не "Отмена", то это fallbacks, который должен завершить диалог.
 
-# --- Главная функция ---
+# --- Жизненный цикл приложения ---
 
-def main() -> None:
-    """Запускает бота в режиме Webhook."""
-    
-    # 0. Проверка наличия токенов
-    if not TELEGRAM_TOKEN or not RENDER_EXTERNAL_HOSTNAME:
-        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: TELEGRAM_TOKEN или RENDER_EXTERNAL_HOSTNAME не установлены.")
-        logger.error("Пожалуйста, установите переменные среды на Render и перезапустите сервис.")
-        return # Критический выход
+async def post_init(application: Application) -> None:
+    """Инициализирует Firestore и запускает фоновые задачи после инициализации приложения."""
+    global survey_writer_task
 
-    # 1. Инициализация Firebase/Firestore
+    # Клиент Firestore создается уже внутри работающего цикла событий (uvloop),
+    # чтобы его gRPC-канал был привязан к тому же циклу, что и обработчики
     init_firebase()
-    
-    logger.info("Инициализация приложения Telegram Bot...")
-    
-    # 2. Создание Application
-    # URL для Webhook будет полным URL, который мы сообщаем Telegram
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if db is not None:
+        survey_writer_task = asyncio.create_task(survey_batch_writer())
+        logger.info("Фоновая пакетная запись опросов запущена.")
+
+async def post_stop(application: Application) -> None:
+    """Дожидается записи всех опросов, оставшихся в очереди, перед остановкой."""
+    global survey_writer_task
+
+    if survey_writer_task is None:
+        return
+
+    # Сигнал ставится в конец очереди, поэтому все опросы перед ним будут записаны
+    await survey_write_queue.put(SURVEY_QUEUE_STOP)
+    await survey_writer_task
+    survey_writer_task = None
+    logger.info("Фоновая пакетная запись опросов остановлена, очередь записана.")
+
+async def post_shutdown(application: Application) -> None:
+    """Закрывает клиент Firestore после остановки приложения."""
+    global db
+    global users_col
+
+    if db is None:
+        return
+
+    # AsyncClient.close() закрывает только HTTP-сессию, поэтому gRPC-канал закрывается
+    # через транспорт; если клиент ни разу не обращался к API, канал еще не создан.
+    # Это внутренние атрибуты клиента (версия google-cloud-firestore закреплена
+    # в requirements.txt): если они изменятся, остановка не должна падать.
+    try:
+        if db._firestore_api_internal is not None:
+            await db._firestore_api.transport.close()
+    except AttributeError as e:
+        logger.warning("Не удалось закрыть gRPC-канал Firestore: %s", e)
+    db.close()
+    db = None
+    users_col = None
+    clear_user_ref_cache()
+    bind_save_functions()
+    logger.info("Клиент Firestore закрыт.")
+
+# --- Сборка приложения ---
+
+application = None # Экземпляр Application, создается в main() или lifespan()
+
+# Число обновлений каждого пользователя, переданных в очередь PTB и еще не обработанных.
+# Пока у пользователя есть такие обновления, webhook не отвечает ему в теле ответа:
+# ответ обогнал бы более раннее обновление (например, нажатие кнопки опроса).
+pending_updates: dict[int, int] = {}
+
+def release_pending_update(update: object) -> None:
+    """Снимает отметку об обработанном обновлении пользователя."""
+    user = update.effective_user if isinstance(update, Update) else None
+    if user is None:
+        return
+    count = pending_updates.get(user.id, 0) - 1
+    if count > 0:
+        pending_updates[user.id] = count
+    else:
+        pending_updates.pop(user.id, None)
+
+class PendingUpdateProcessor(SimpleUpdateProcessor):
+    """Обрабатывает обновления по одному и снимает отметку pending_updates после обработки."""
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            await coroutine
+        finally:
+            release_pending_update(update)
+
+def build_application(with_updater: bool = True) -> Application:
+    """Создает Application и регистрирует все обработчики.
+
+    Для ASGI-сервера встроенный Updater не нужен: обновления приходят через маршрут Starlette.
+    """
+    # Один постоянный пул HTTP/2-соединений к api.telegram.org для всех ответов бота.
+    # Простаивающие соединения держатся открытыми минуту, чтобы ответы не платили за TLS-handshake.
+    request = HTTPXRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        http_version="2",
+        connect_timeout=5,
+        read_timeout=20,
+        pool_timeout=10,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=TELEGRAM_POOL_SIZE,
+                max_keepalive_connections=TELEGRAM_POOL_SIZE // 2,
+                keepalive_expiry=60,
+            ),
+        },
+    )
+    # Состояние диалогов и user_data сбрасываются на диск фоновой задачей PTB раз в минуту,
+    # поэтому незавершенный опрос переживает перезапуск сервиса
+    persistence = PicklePersistence(
+        filepath=PERSISTENCE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        update_interval=60,
+    )
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(request)
+        .persistence(persistence)
+        # Обновления обрабатываются строго по одному (max_concurrent_updates=1):
+        # ConversationHandler рассчитан на последовательную обработку, иначе два быстрых
+        # сообщения в одном шаге опроса обрабатываются параллельно и сохраняют опрос дважды.
+        # Запись в Firestore асинхронная и не блокирует цикл, так что последовательная
+        # обработка не ждет сеть БД. Процессор лишь отмечает обработанные обновления.
+        .concurrent_updates(PendingUpdateProcessor(1))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
-    # 3. Регистрация диалогов
-    
     # Диалог обратной связи
     feedback_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex(f"^{FEEDBACK_BTN}$"), feedback_start)],
+        name="feedback",
+        persistent=True,
+        entry_points=[MessageHandler(BUTTON_FILTERS[FEEDBACK_BTN], feedback_start)],
         states={
-            FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), feedback_process)],
+            FEEDBACK: [MessageHandler(ANSWER_FILTER, feedback_process)],
         },
-        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex(f"^{CANCEL_BTN}$"), cancel)],
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(BUTTON_FILTERS[CANCEL_BTN], cancel)],
     )
 
     # Диалог опроса
     survey_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex(f"^{SURVEY_BTN}$"), survey_start)],
+        name="survey",
+        persistent=True,
+        entry_points=[MessageHandler(BUTTON_FILTERS[SURVEY_BTN], survey_start)],
         states={
-            Q1_PAIN: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), q1_pain)],
-            Q2_SLEEP: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), q2_sleep)],
-            Q3_MEDICATION: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), q3_medication)],
-            Q4_SIDE_EFFECTS: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), q4_side_effects)],
-            Q5_COMMENTS: [MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{CANCEL_BTN}$"), q5_comments_and_save)],
+            step.state: [MessageHandler(ANSWER_FILTER, functools.partial(survey_step, index))]
+            for index, step in enumerate(SURVEY_STEPS)
         },
-        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex(f"^{CANCEL_BTN}$"), cancel)],
+        fallbacks=[CommandHandler("cancel", cancel), MessageHandler(BUTTON_FILTERS[CANCEL_BTN], cancel)],
     )
 
-    # 4. Регистрация обработчиков
-    application.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("start", start))
 
     # Добавляем диалоги
-    application.add_handler(survey_conv_handler)
-    application.add_handler(feedback_conv_handler)
+    app.add_handler(survey_conv_handler)
+    app.add_handler(feedback_conv_handler)
 
-    # Добавляем обработчики для кнопок-команд
-    application.add_handler(MessageHandler(filters.Regex(f"^{ILLNESS_BTN}$"), show_illness_info))
-    application.add_handler(MessageHandler(filters.Regex(f"^{INFO_BTN}$"), show_info))
-    application.add_handler(MessageHandler(filters.Regex(f"^{EMERGENCY_BTN}$"), show_emergency))
+    # Справочные кнопки и любой другой текст: один обработчик с таблицей маршрутов.
+    # Регистрируется после диалогов, чтобы их точки входа срабатывали первыми.
+    app.add_handler(MessageHandler(ROUTER_FILTER, route_text))
 
-    # Обработчик для любого другого текста (на случай, если пользователь просто пишет)
-    async def other_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text(
-            "Я не понял ваш запрос. Пожалуйста, используйте кнопки меню.",
-            reply_markup=get_main_menu_keyboard()
-        )
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(f"^{SURVEY_BTN}$") & ~filters.Regex(f"^{FEEDBACK_BTN}$") & ~filters.Regex(f"^{ILLNESS_BTN}$") & ~filters.Regex(f"^{INFO_BTN}$") & ~filters.Regex(f"^{EMERGENCY_BTN}$"), other_text))
+    logger.info("Application handlers set up successfully.")
+    return app
+
+# --- ASGI-приложение (uvicorn) ---
+
+# Ответы на кнопки справочных разделов отправляются прямо в теле ответа на webhook
+# (Telegram выполняет указанный в нем метод), без отдельного HTTPS-запроса к Bot API
+WEBHOOK_STATIC_REPLIES = {
+    button: {
+        "method": "sendMessage",
+        "text": reply["text"],
+        "parse_mode": reply["parse_mode"],
+        "reply_markup": reply["reply_markup"].to_dict(),
+    }
+    for button, reply in (
+        (ILLNESS_BTN, ILLNESS_REPLY),
+        (INFO_BTN, INFO_REPLY),
+        (EMERGENCY_BTN, EMERGENCY_REPLY),
+    )
+}
+
+def get_webhook_reply(update: Update) -> dict | None:
+    """Возвращает ответ для тела webhook, если обновление - нажатие справочной кнопки вне диалога.
+
+    Результат метода из тела ответа Telegram не сообщает, поэтому быстрый путь используется
+    только для статических ответов и только когда у пользователя нет необработанных обновлений.
+    """
+    message = update.message
+    if message is None or message.text not in WEBHOOK_STATIC_REPLIES:
+        return None
+    # Более ранние обновления пользователя еще в очереди или обрабатываются: состояние
+    # диалога может измениться, а ответ не должен их обгонять
+    user = update.effective_user
+    if user is None or user.id in pending_updates:
+        return None
+    # Внутри опроса или обратной связи текст кнопки - это ответ пользователя,
+    # его должен обработать диалог
+    for handler in application.handlers[0]:
+        if isinstance(handler, ConversationHandler) and handler.check_update(update):
+            return None
+    return {**WEBHOOK_STATIC_REPLIES[message.text], "chat_id": message.chat_id}
+
+async def telegram_webhook(request: Request) -> Response:
+    """Принимает обновление от Telegram и передает его в очередь обработки PTB."""
+    update = Update.de_json(await request.json(), application.bot)
+    reply = get_webhook_reply(update)
+    if reply is not None:
+        return JSONResponse(reply)
+    # Отметка ставится до await, чтобы следующее обновление пользователя уже ее видело
+    user = update.effective_user
+    if user is not None:
+        pending_updates[user.id] = pending_updates.get(user.id, 0) + 1
+    await application.update_queue.put(update)
+    return Response()
 
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    """Запускает и останавливает PTB вместе с ASGI-сервером."""
+    global application
 
-    logger.info("Application handlers set up successfully.")
+    if not TELEGRAM_TOKEN or not RENDER_EXTERNAL_HOSTNAME:
+        raise RuntimeError("TELEGRAM_TOKEN или RENDER_EXTERNAL_HOSTNAME не установлены.")
+
+    application = build_application(with_updater=False)
+    async with application:
+        # post_init вызывается только из run_webhook/run_polling, поэтому вызываем его сами
+        await post_init(application)
+        await application.bot.set_webhook(url=WEBHOOK_URL)
+        await application.start()
+        logger.info("ASGI-приложение запущено, Webhook: %s", WEBHOOK_URL)
+        yield
+        await application.stop()
+        # post_stop, как и post_init, вызывается только из run_webhook/run_polling
+        await post_stop(application)
+    # То же относится к post_shutdown: вызывается после application.shutdown()
+    await post_shutdown(application)
+
+# Обновления принимаются одним процессом: состояние диалогов хранится в памяти процесса,
+# поэтому uvicorn запускается с одним worker'ом (см. Procfile)
+app = Starlette(
+    routes=[Route(f"/{WEBHOOK_PATH}", telegram_webhook, methods=["POST"])],
+    lifespan=lifespan,
+)
+
+# --- Главная функция ---
+
+def main() -> None:
+    """Запускает бота в режиме Webhook на встроенном сервере PTB (для локального запуска)."""
+    global application
+    
+    # 0. Проверка наличия токенов
+    if not TELEGRAM_TOKEN or not RENDER_EXTERNAL_HOSTNAME:
+        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА: TELEGRAM_TOKEN или RENDER_EXTERNAL_HOSTNAME не установлены.")
+        logger.error("Пожалуйста, установите переменные среды на Render и перезапустите сервис.")
+        return # Критический выход
+
+    # uvloop - более быстрый цикл событий; на платформах без него (Windows) остается стандартный asyncio
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Используется цикл событий uvloop.")
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный цикл событий asyncio.")
+
+    # Firebase/Firestore инициализируется в post_init, уже внутри цикла событий
+    logger.info("Инициализация приложения Telegram Bot...")
+    
+    # 1. Создание Application и регистрация обработчиков
+    application = build_application()
     
-    # 5. Запуск бота в режиме Webhook
-    logger.info(f"Запуск Webhook на порту {PORT} с URL: https://{WEBHOOK_URL}")
+    # 2. Запуск бота в режиме Webhook
+    logger.info("Запуск Webhook на порту %s с URL: %s", PORT, WEBHOOK_URL)
     application.run_webhook(
         listen="0.0.0.0",
         port=PORT,
         url_path=WEBHOOK_PATH,
-        webhook_url=f"https://{WEBHOOK_URL}", # Полный URL, который мы сообщаем Telegram
+        webhook_url=WEBHOOK_URL, # Полный URL, который мы сообщаем Telegram
     )
 
 if __name__ == "__main__":